@@ -1,42 +1,273 @@
 import os
 import sys
 import json
+import hashlib
+import io
+import importlib
 import gradio as gr
 import subprocess
-import shutil
-import traceback
+import queue
+import signal
+import threading
+import time
+import shlex
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
 from shared.utils.plugins import WAN2GPPlugin
 from shared.utils.process_locks import acquire_GPU_ressources, release_GPU_ressources, any_GPU_process_running
 
 MUSUBI_REPO_URL = "https://github.com/Tophness/musubi-tuner.git"
 DEFAULT_INSTALL_DIR_NAME = "musubi-tuner"
+_PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+_DEFAULT_INSTALL = os.path.join(_PLUGIN_DIR, DEFAULT_INSTALL_DIR_NAME)
+_CONFIG_FILE = os.path.join(_PLUGIN_DIR, "config.json")
+_GUI_DIR_REL = os.path.join("src", "musubi_tuner", "gui")
+_PIP_INSTALL = [sys.executable, "-m", "pip", "install", "-e"]
+
+_CWD_LOCK = threading.Lock()
+_INSTALL_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="musubi_install")
+_LOG_UPDATE_INTERVAL = 0.2
+_REMOTE_CHECK_TIMEOUT = 15
+
+
+# A chain step that only runs when ``path`` exists (and counts as success when it does not).
+_IfExists = namedtuple("_IfExists", ["path", "argv"])
+
+
+def _shell_join(args):
+    if isinstance(args, _IfExists):
+        if os.name == "nt":
+            # Display only: Windows steps never go through cmd.exe (see _run_cmd_stream).
+            return f"if exist {subprocess.list2cmdline([args.path])} {_shell_join(args.argv)}"
+        return f"{{ [ ! -e {shlex.quote(args.path)} ] || {_shell_join(args.argv)}; }}"
+    if os.name == "nt":
+        return subprocess.list2cmdline(args)
+    return shlex.join(args)
+
+
+def _chain_commands(commands):
+    return " && ".join(_shell_join(cmd) for cmd in commands)
+
+
+def _json_loads(data):
+    if _HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    if _HAS_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=4).encode("utf-8")
+
+
+def _pyproject_hash(install_path):
+    """Fingerprint of the pyproject.toml that ``pip install -e`` resolved for ``install_path`` in this interpreter, or None if there is none."""
+    try:
+        with open(os.path.join(install_path, "pyproject.toml"), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # The interpreter and path are part of the key: the editable install lives in one specific
+    # environment and points at one specific checkout.
+    key = b"\0".join([os.fsencode(sys.executable), os.fsencode(install_path), data])
+    return hashlib.blake2b(key, digest_size=16).hexdigest()
+
+
+def _spawn_shell(commands):
+    """Run ``commands`` chained with ``&&`` in a single shell process, with stderr folded into a binary stdout pipe.
+
+    cmd.exe metacharacters (``&``, ``|``, ``^``, ``%``...) cannot be reliably escaped, so on Windows
+    no shell is used and ``commands`` must hold a single argv list (see _run_cmd_stream).
+
+    No spawn tuning is needed to avoid fork()ing the large WanGP process: without ``preexec_fn``,
+    CPython 3.10+ already spawns through vfork on Linux. Commands carry their own working directory
+    (``git -C``, absolute pip targets) purely so every step of a chain states where it runs. On POSIX
+    the shell leads its own session so a cancelled install can signal the whole chain, not just
+    the shell.
+    """
+    if os.name == "nt":
+        (args,) = commands
+    else:
+        args = _chain_commands(commands)
+    return subprocess.Popen(
+        args,
+        shell=os.name != "nt",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env={**os.environ, "GIT_PROGRESS_DELAY": "0"},
+        start_new_session=os.name != "nt"
+    )
+
+
+def _terminate(proc):
+    if os.name == "nt":
+        proc.terminate()
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def _run_cmd_stream(commands, output_queue, cancelled):
+    # Windows has no injection-safe shell chain: run the steps one after another, stopping at the first failure.
+    steps = [[cmd] for cmd in commands] if os.name == "nt" else [commands]
+    returncode = 0
+    for step in steps:
+        if cancelled.is_set():
+            break
+        if os.name == "nt" and isinstance(step[0], _IfExists):
+            if not os.path.exists(step[0].path):
+                continue
+            step = [step[0].argv]
+        proc = _spawn_shell(step)
+        output_queue.put(proc)
+        # newline="" keeps the bare "\r" git ends progress redraws with, so _stream_shell can
+        # overwrite the previous redraw instead of logging every frame.
+        with io.TextIOWrapper(proc.stdout, errors="replace", newline="") as stdout:
+            for line in stdout:
+                output_queue.put(line)
+        returncode = proc.wait()
+        if returncode != 0:
+            break
+    return returncode
+
+
+def _stream_shell(commands, log):
+    """Run ``commands`` on _INSTALL_EXECUTOR, appending their output to ``log`` and yielding Gradio updates.
+
+    The handler thread only waits on the queue in short slices and yields at most one update per
+    _LOG_UPDATE_INTERVAL (a no-op one when idle), so Gradio can cancel the event between slices
+    without the textbox being resent for every line; closing the generator terminates the child.
+    Returns the exit code (``returncode = yield from _stream_shell(...)``).
+    """
+    output_queue = queue.Queue()
+    cancelled = threading.Event()
+    future = _INSTALL_EXECUTOR.submit(_run_cmd_stream, commands, output_queue, cancelled)
+    proc = None
+    redraw = False
+    dirty = False
+    last_update = time.monotonic()
+    try:
+        while not future.done() or not output_queue.empty():
+            try:
+                item = output_queue.get(timeout=_LOG_UPDATE_INTERVAL)
+            except queue.Empty:
+                item = None
+            if isinstance(item, subprocess.Popen):
+                proc = item
+            elif item is not None:
+                line = item.rstrip("\r\n") + "\n"
+                if redraw:
+                    log[-1] = line
+                else:
+                    log.append(line)
+                redraw = item.endswith("\r")
+                dirty = True
+            now = time.monotonic()
+            if now - last_update >= _LOG_UPDATE_INTERVAL:
+                yield gr.update(value="".join(log)) if dirty else gr.update()
+                dirty = False
+                last_update = now
+        if dirty:
+            yield gr.update(value="".join(log))
+        return future.result()
+    finally:
+        cancelled.set()
+        if not future.cancel():
+            # The worker may have spawned a step it has not handed over yet: keep collecting
+            # until it finishes so no child outlives a cancelled event.
+            while True:
+                if proc is not None and proc.poll() is None:
+                    _terminate(proc)
+                if future.done() and output_queue.empty():
+                    break
+                try:
+                    item = output_queue.get(timeout=_LOG_UPDATE_INTERVAL)
+                except queue.Empty:
+                    continue
+                if isinstance(item, subprocess.Popen):
+                    proc = item
+
 
 class MusubiTrainingPlugin(WAN2GPPlugin):
+    _CONFIG_CACHE = {}
+
     def __init__(self):
         super().__init__()
         self.name = "Musubi Tuner Training"
         self.plugin_id = "musubi_training"
         self.version = "1.1.6"
         self.description = "Integrates Kohya-ss Musubi Tuner for Wan2.1 training directly into Wan2GP."
-        self.config_file = os.path.join(os.path.dirname(__file__), "config.json")
+        self.config_file = _CONFIG_FILE
+        self._validity_cache = {}
+        self._musubi_gui = None
+        self._path_registered = False
         self.config = self.load_config()
 
     def load_config(self):
-        if os.path.exists(self.config_file):
+        try:
+            mtime = os.stat(self.config_file).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is not None:
+            cached = self._CONFIG_CACHE.get(self.config_file)
+            if cached and cached[0] == mtime:
+                return dict(cached[1])
             try:
-                with open(self.config_file, "r") as f:
-                    return json.load(f)
-            except:
-                pass
-        local_install = os.path.join(os.path.dirname(__file__), DEFAULT_INSTALL_DIR_NAME)
-        if os.path.exists(os.path.join(local_install, "src", "musubi_tuner", "gui", "gui.py")):
-            return {"install_path": local_install}
+                with open(self.config_file, "rb") as f:
+                    config = _json_loads(f.read())
+                if not isinstance(config, dict):
+                    raise ValueError(f"expected a JSON object, got {type(config).__name__}")
+            # JSONDecodeError (both backends) and UnicodeDecodeError are ValueErrors.
+            except (ValueError, OSError) as e:
+                print(f"[{self.plugin_id}] Ignoring unreadable {self.config_file}: {e}")
+            else:
+                self._CONFIG_CACHE[self.config_file] = (mtime, config)
+                return dict(config)
+        if self._is_installed(_DEFAULT_INSTALL):
+            return {"install_path": _DEFAULT_INSTALL}
         return {"install_path": ""}
 
-    def save_config(self, path):
-        self.config["install_path"] = path
-        with open(self.config_file, "w") as f:
-            json.dump(self.config, f, indent=4)
+    def _is_installed(self, path):
+        gui_dir = os.path.join(path, _GUI_DIR_REL)
+        try:
+            mtime = os.stat(gui_dir).st_mtime
+        except OSError:
+            return False
+        cached = self._validity_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        valid = self._probe_install(path)["gui_py"]
+        self._validity_cache[path] = (mtime, valid)
+        return valid
+
+    def _probe_install(self, path):
+        try:
+            with os.scandir(os.path.join(path, _GUI_DIR_REL)) as it:
+                entries = {entry.name for entry in it}
+        except OSError:
+            entries = set()
+        return {"gui_py": "gui.py" in entries}
+
+    def save_config(self, path, **extra):
+        config = {**self.config, "install_path": path, **extra}
+        if config == self.config and os.path.exists(self.config_file):
+            return
+        self.config = config
+        tmp_file = self.config_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(_json_dumps(self.config))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.config_file)
+        self._CONFIG_CACHE[self.config_file] = (os.stat(self.config_file).st_mtime, dict(self.config))
 
     def setup_ui(self):
         self.request_component("state")
@@ -60,16 +291,14 @@ class MusubiTrainingPlugin(WAN2GPPlugin):
 
     def create_ui(self):
         current_path = self.config.get("install_path", "")
-        is_ready = False
-        if current_path and os.path.isdir(current_path):
-            if os.path.exists(os.path.join(current_path, "src", "musubi_tuner", "gui", "gui.py")):
-                is_ready = True
+        is_ready = bool(current_path) and self._is_installed(current_path)
         path_state = gr.State(value=current_path)
 
         if is_ready:
             try:
                 self.render_musubi_ui(current_path, path_state)
             except Exception as e:
+                import traceback
                 trace = traceback.format_exc()
                 gr.Markdown(
                     f"## Error Loading Training Interface\n"
@@ -85,7 +314,7 @@ class MusubiTrainingPlugin(WAN2GPPlugin):
     def render_installer_ui(self, current_path, path_state):
         with gr.Blocks() as installer:
             if not current_path:
-                current_path = os.path.join(os.path.dirname(__file__), DEFAULT_INSTALL_DIR_NAME)
+                current_path = _DEFAULT_INSTALL
 
             gr.Markdown("## Musubi Tuner Installation")
             gr.Markdown("Musubi Tuner is required to enable training features. Please install it below.")
@@ -109,35 +338,43 @@ class MusubiTrainingPlugin(WAN2GPPlugin):
                     return
                 
                 target_path = os.path.abspath(target_path)
+                pip_install = [*_PIP_INSTALL, target_path]
 
                 if not os.path.exists(os.path.join(target_path, ".git")):
-                    try:
-                        yield f"Cloning {MUSUBI_REPO_URL} into {target_path}..."
-                        subprocess.check_call(["git", "clone", MUSUBI_REPO_URL, target_path])
-                    except Exception as e:
-                        yield f"Error cloning git repo: {e}"
-                        return
+                    log = [f"Cloning {MUSUBI_REPO_URL} into {target_path} and installing dependencies (this may take a minute)...\n"]
+                    # Shallow clone: the plugin only runs the current tree; history is not available locally, the plugin never reads it.
+                    commands = [
+                        ["git", "clone", "--progress", "--depth", "1", MUSUBI_REPO_URL, target_path],
+                        _IfExists(os.path.join(target_path, "pyproject.toml"), pip_install)
+                    ]
+                elif os.path.exists(os.path.join(target_path, "pyproject.toml")):
+                    if _pyproject_hash(target_path) == self.config.get("pyproject_hash"):
+                        log = [f"Git repository already exists at {target_path}. Dependencies already up to date, skipping pip.\n"]
+                        commands = []
+                    else:
+                        log = [f"Git repository already exists at {target_path}. Installing dependencies via 'pip install -e .' (this may take a minute)...\n"]
+                        commands = [pip_install]
                 else:
-                    yield f"Git repository already exists at {target_path}. Proceeding to install..."
+                    log = [f"Git repository already exists at {target_path}. Nothing to install.\n"]
+                    commands = []
 
-                pyproject_file = os.path.join(target_path, "pyproject.toml")
-                if os.path.exists(pyproject_file):
+                yield "".join(log)
+                if commands:
                     try:
-                        yield "Installing dependencies via 'pip install -e .' (this may take a minute)..."
-                        subprocess.check_call(
-                            [sys.executable, "-m", "pip", "install", "-e", "."], 
-                            cwd=target_path
-                        )
+                        returncode = yield from _stream_shell(commands, log)
                     except Exception as e:
-                        yield f"Error installing dependencies: {e}"
+                        yield "".join(log) + f"\nError running install: {e}"
+                        return
+                    if returncode != 0:
+                        yield "".join(log) + f"\nInstallation failed (exit code {returncode})."
                         return
 
-                self.save_config(target_path)
+                self.save_config(target_path, pyproject_hash=_pyproject_hash(target_path))
                 yield "SUCCESS: Installation Complete!\n\nIMPORTANT: Please restart WanGP to load the training interface."
 
             def save_only(path):
                 self.save_config(path)
-                return "Path saved. Please restart WanGP if you are changing a valid installation location."
+                return "Path saved. Please restart WanGP if you are changing a valid installation location.", path
 
             install_btn.click(
                 install_musubi, inputs=[path_input], outputs=[status_box]
@@ -146,90 +383,111 @@ class MusubiTrainingPlugin(WAN2GPPlugin):
             )
 
             save_path_btn.click(
-                save_only, inputs=[path_input], outputs=[status_box]
-            ).then(
-                fn=lambda p: p, inputs=[path_input], outputs=[path_state]
+                save_only, inputs=[path_input], outputs=[status_box, path_state]
             )
 
     def render_musubi_ui(self, musubi_path, path_state):
-        src_path = os.path.join(musubi_path, "src")
-        if src_path not in sys.path:
-            sys.path.insert(0, src_path)
-
-        original_cwd = os.getcwd()
-        
-        try:
-            os.chdir(musubi_path)
-
-            import musubi_tuner.gui.gui as musubi_gui
-            musubi_gui.construct_ui()
-
-            gr.Markdown("---")
-            with gr.Accordion("Musubi Installation Management", open=False):
-                with gr.Row(variant="panel"):
-                    path_edit = gr.Textbox(label="Installation Path", value=musubi_path, scale=4)
-                    update_path_btn = gr.Button("Save New Path", scale=1)
-                    git_update_btn = gr.Button("Update from GitHub", scale=1)
-                
-                update_log = gr.Textbox(label="Logs", visible=False, lines=5)
-
-                def do_update_path(new_path):
-                    self.save_config(new_path)
-                    return new_path, "Path saved. Please restart WanGP to load the new location."
-
-                def do_git_update():
-                    log = []
+        if not self._path_registered:
+            src_path = os.path.join(musubi_path, "src")
+            # Position 0, so an editable install left by a previous checkout cannot shadow the configured one.
+            if src_path not in sys.path:
+                sys.path.insert(0, src_path)
+                importlib.invalidate_caches()
+            self._path_registered = True
+
+        # musubi's construct_ui resolves paths relative to its checkout, but os.chdir is
+        # process-wide: keep the switch as short as possible and serialize overlapping renders.
+        with _CWD_LOCK:
+            original_cwd = os.getcwd()
+            try:
+                os.chdir(musubi_path)
+
+                if self._musubi_gui is None:
+                    import musubi_tuner.gui.gui as musubi_gui
+                    self._musubi_gui = musubi_gui
+                self._musubi_gui.construct_ui()
+            finally:
+                os.chdir(original_cwd)
+
+        gr.Markdown("---")
+        with gr.Accordion("Musubi Installation Management", open=False):
+            with gr.Row(variant="panel"):
+                path_edit = gr.Textbox(label="Installation Path", value=musubi_path, scale=4)
+                update_path_btn = gr.Button("Save New Path", scale=1)
+                git_update_btn = gr.Button("Update from GitHub", scale=1)
+            
+            update_log = gr.Textbox(label="Logs", visible=False, lines=5)
+
+            def do_update_path(new_path):
+                self.save_config(new_path)
+                return new_path, gr.update(value="Path saved. Please restart WanGP to load the new location.", visible=True)
+
+            def do_git_update():
+                log = []
+
+                def run(commands):
+                    log.append(f"Executing: {_chain_commands(commands)}\n")
+                    yield gr.update(value="".join(log), visible=True)
+                    return (yield from _stream_shell(commands, log))
+
+                def upstream_matches():
+                    git = ["git", "-C", musubi_path]
+                    # Never block on a credential prompt or a stalled remote: fall back to the pull instead.
+                    probe = dict(
+                        text=True,
+                        stdin=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        timeout=_REMOTE_CHECK_TIMEOUT,
+                        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+                    )
                     try:
-                        log.append("Executing: git pull")
-                        result = subprocess.run(
-                            ["git", "pull"], 
-                            cwd=musubi_path, 
-                            capture_output=True, 
-                            text=True
-                        )
-                        log.append(result.stdout)
-                        if result.stderr:
-                            log.append(f"STDERR: {result.stderr}")
-                        
-                        if result.returncode != 0:
-                            log.append("Git pull failed.")
-                            return "\n".join(log), gr.update(visible=True)
-
-                        pyproject_path = os.path.join(musubi_path, "pyproject.toml")
-                        if os.path.exists(pyproject_path):
-                            log.append("\nUpdating dependencies (pip install -e .)...")
-                            try:
-                                pip_res = subprocess.run(
-                                    [sys.executable, "-m", "pip", "install", "-e", "."],
-                                    cwd=musubi_path,
-                                    capture_output=True,
-                                    text=True
-                                )
-                                log.append(pip_res.stdout)
-                                if pip_res.returncode != 0:
-                                    log.append(f"Pip error: {pip_res.stderr}")
-                            except Exception as e:
-                                log.append(f"Pip exception: {e}")
-                        
-                        log.append("\nUpdate process finished. Please restart WanGP if code changes require it.")
+                        branch_ref = subprocess.check_output(git + ["symbolic-ref", "-q", "HEAD"], **probe).strip()
+                        local_head, remote, remote_ref = subprocess.check_output(
+                            git + ["for-each-ref", "--format=%(objectname) %(upstream:remotename) %(upstream:remoteref)", branch_ref],
+                            **probe
+                        ).split()
+                        remote_line = subprocess.check_output(git + ["ls-remote", remote, remote_ref], **probe).strip()
+                    except (OSError, ValueError, subprocess.SubprocessError):
+                        return False
+                    return bool(remote_line) and remote_line.split()[0] == local_head
+
+                try:
+                    log.append("Checking the tracked remote branch for updates...\n")
+                    yield gr.update(value="".join(log), visible=True)
+                    if upstream_matches():
+                        log.append("Already up to date, skipping git pull.\n")
+                        yield gr.update(value="".join(log), visible=True)
+                    else:
+                        returncode = yield from run([["git", "-C", musubi_path, "pull", "--ff-only", "--progress"]])
+                        if returncode != 0:
+                            log.append(f"\nGit pull failed (exit code {returncode}).")
+                            yield gr.update(value="".join(log), visible=True)
+                            return
+
+                    pyproject_hash = _pyproject_hash(musubi_path)
+                    if pyproject_hash is not None:
+                        if pyproject_hash == self.config.get("pyproject_hash"):
+                            log.append("\nDependencies already up to date, skipping pip.\n")
+                        else:
+                            returncode = yield from run([[*_PIP_INSTALL, musubi_path]])
+                            if returncode != 0:
+                                log.append(f"\nPip install failed (exit code {returncode}).")
+                                yield gr.update(value="".join(log), visible=True)
+                                return
+                            self.save_config(self.config.get("install_path", musubi_path), pyproject_hash=pyproject_hash)
+
+                    log.append("\nUpdate process finished. Please restart WanGP if code changes require it.")
+
+                except Exception as e:
+                    log.append(f"\nCritical Error: {str(e)}")
+                
+                yield gr.update(value="".join(log), visible=True)
 
-                    except Exception as e:
-                        log.append(f"Critical Error: {str(e)}")
-                    
-                    return "\n".join(log), gr.update(visible=True)
-
-                update_path_btn.click(
-                    do_update_path, inputs=[path_edit], outputs=[path_state, update_log]
-                ).then(
-                    lambda: gr.update(visible=True), outputs=[update_log]
-                )
+            update_path_btn.click(
+                do_update_path, inputs=[path_edit], outputs=[path_state, update_log]
+            )
 
-                git_update_btn.click(do_git_update, outputs=[update_log, update_log])
-            
-        except ImportError as e:
-            raise e
-        finally:
-            os.chdir(original_cwd)
+            git_update_btn.click(do_git_update, outputs=[update_log])
 
     def on_tab_select(self, state):
         self.acquire_gpu(state)